@@ -1,6 +1,11 @@
+import time
+
+# Marca de inicio de importación para medir el arranque en frío (ver /ready)
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import logging
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
@@ -9,8 +14,14 @@ import httpx
 import json
 import urllib.parse
 import hashlib
+import math
+import sqlite3
+import tempfile
+import threading
 import psycopg2
 from psycopg2 import pool, extras
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
 
 # Configuración de logs
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +29,242 @@ log = logging.getLogger("uvicorn.error")
 
 app = FastAPI()
 
+# --- CONTROL DE ADMISIÓN Y LÍMITE DE TASA ---
+# Cada worker de gunicorn tiene su propio pool de conexiones. El limitador de
+# concurrencia se aplica por worker (protege ese pool) y los token buckets se
+# guardan en un SQLite local compartido por todos los workers de la máquina.
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_CONCURRENCY_LIMIT = int(os.getenv("DB_CONCURRENCY_LIMIT", str(DB_POOL_MAX)))
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+# SQLite local con el estado compartido entre workers (rate limit y read-your-writes)
+LOCAL_STATE_DB_PATH = os.getenv(
+    "LOCAL_STATE_DB_PATH", os.path.join(tempfile.gettempdir(), "securityeye_state.sqlite3")
+)
+
+# Solo con un proxy delante que añada X-Forwarded-For (Render) se usa su último salto;
+# sin él la cabecera la controla el cliente y se usa la IP de la conexión
+RATE_LIMIT_TRUST_XFF = os.getenv("RATE_LIMIT_TRUST_XFF", "0") == "1"
+# Una IP puede agrupar a muchos usuarios (NAT de un laboratorio o campus): sus
+# buckets por ruta son RATE_LIMIT_IP_FACTOR veces los de un usuario
+RATE_LIMIT_IP_FACTOR = float(os.getenv("RATE_LIMIT_IP_FACTOR", "10"))
+
+
+def _parse_rate_limit(name, default):
+    """Lee un límite "capacidad/recarga_por_segundo" de la variable de entorno `name`."""
+    value = os.getenv(name)
+    if not value:
+        return default
+    capacity, refill = value.split("/")
+    return float(capacity), float(refill)
+
+
+# Rutas que usan la BD: prefijo -> (capacidad del bucket, tokens recargados por segundo)
+# por usuario. Cada una se puede cambiar con RATE_LIMIT_<RUTA>, p. ej.
+# RATE_LIMIT_SAVE_FATIGUE="5/0.1" o RATE_LIMIT_END_SESSION="10/0.2".
+DB_ROUTE_LIMITS = {
+    route: _parse_rate_limit("RATE_LIMIT_" + route.strip("/").replace("-", "_").upper(), default)
+    for route, default in {
+        "/register": (5, 0.1),
+        "/login": (10, 0.2),
+        "/create-session": (10, 0.2),
+        "/save-fatigue": (5, 0.1),
+        "/get-user-history": (10, 0.5),
+        "/registrar-descanso": (20, 0.5),
+        "/end-session/": (10, 0.2),
+        "/sesiones/": (30, 1.0),
+        "/get-or-create-diagnosis": (10, 0.5),
+        "/get-session-details": (30, 1.0),
+    }.items()
+}
+# Bucket global por IP de cliente, sumando todas las rutas de BD
+CLIENT_RATE_LIMIT = _parse_rate_limit("RATE_LIMIT_CLIENT", (600, 20.0))
+
+
+class LocalStateStore:
+    """Estado en un SQLite local compartido entre los workers (una conexión por hilo)."""
+
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self.SCHEMA)
+            self._local.conn = conn
+        return conn
+
+
+class TokenBucketStore(LocalStateStore):
+    """Token buckets persistidos en SQLite para compartir estado entre procesos."""
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+    PRUNE_EVERY = 1000
+    PRUNE_AGE_SEC = 3600
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._calls = 0
+
+    def take(self, buckets):
+        """
+        Consume un token de cada bucket [(clave, capacidad, recarga)] de forma atómica.
+        Devuelve los segundos de espera sugeridos (0 si la petición se admite).
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = {}
+            retry_after = 0.0
+            for key, capacity, refill in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * refill)
+                state[key] = tokens
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / refill)
+            # Solo se descuenta si todos los buckets tienen saldo
+            for key, tokens in state.items():
+                if not retry_after:
+                    tokens -= 1
+                conn.execute(
+                    "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                    (key, tokens, now),
+                )
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.PRUNE_AGE_SEC,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+class AdmissionControlMiddleware:
+    """
+    Middleware ASGI delante de las rutas de BD:
+    1. Token bucket por IP del cliente y por IP+ruta, más uno por usuario+ruta
+       cuando el cuerpo trae usuario_id (estado compartido en SQLite).
+    2. Límite de peticiones concurrentes por worker para no agotar el pool.
+    Si no hay capacidad responde 429 con Retry-After en vez de encolar hasta el timeout.
+    """
+
+    def __init__(self, app, store, concurrency_limit):
+        self.app = app
+        self.store = store
+        self.concurrency_limit = concurrency_limit
+        self.in_flight = 0
+
+    @staticmethod
+    def _match_route(path):
+        for prefix in DB_ROUTE_LIMITS:
+            if path == prefix or (prefix.endswith("/") and path.startswith(prefix)):
+                return prefix
+        return None
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return b"".join(chunks), message
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks), None
+
+    @staticmethod
+    def _client_ip(scope):
+        # scope["client"] ya viene corregido por uvicorn para proxies de confianza
+        # (forwarded_allow_ips). Con RATE_LIMIT_TRUST_XFF se usa el último salto de
+        # X-Forwarded-For, que añade el proxy; los anteriores los controla el cliente.
+        forwarded = ""
+        if RATE_LIMIT_TRUST_XFF:
+            headers = dict(scope.get("headers") or [])
+            forwarded = headers.get(b"x-forwarded-for", b"").decode("latin-1").split(",")[-1].strip()
+        client = scope.get("client")
+        return forwarded or (client[0] if client else "desconocido")
+
+    @staticmethod
+    def _usuario_id(body):
+        # usuario_id llega sin autenticar en el cuerpo: solo se usa como límite adicional
+        try:
+            return json.loads(body).get("usuario_id") if body else None
+        except (ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def _reject(detail, retry_after):
+        return JSONResponse(
+            {"detail": detail},
+            status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    async def __call__(self, scope, receive, send):
+        route = self._match_route(scope["path"]) if scope["type"] == "http" else None
+        if route is None or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        body, pending = await self._read_body(receive)
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return pending or {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        # La concurrencia se comprueba primero (y se reserva el hueco antes de esperar
+        # al almacén) para no gastar tokens en peticiones que no se van a ejecutar
+        if self.in_flight >= self.concurrency_limit:
+            log.warning(f"Servicio saturado: {self.in_flight} peticiones de BD en curso")
+            await self._reject("Servicio saturado, intenta más tarde", 1)(scope, replay_receive, send)
+            return
+
+        self.in_flight += 1
+        try:
+            if RATE_LIMIT_ENABLED:
+                identity = f"ip:{self._client_ip(scope)}"
+                capacity, refill = DB_ROUTE_LIMITS[route]
+                buckets = [
+                    (f"{identity}:*", *CLIENT_RATE_LIMIT),
+                    (f"{identity}:{route}", capacity * RATE_LIMIT_IP_FACTOR, refill * RATE_LIMIT_IP_FACTOR),
+                ]
+                usuario_id = self._usuario_id(body)
+                if usuario_id is not None:
+                    buckets.append((f"u:{usuario_id}:{route}", capacity, refill))
+                try:
+                    retry_after = await run_in_threadpool(self.store.take, buckets)
+                except sqlite3.Error:
+                    # Si el almacén local falla no bloqueamos el tráfico
+                    log.exception("Error en almacén de rate limit")
+                    retry_after = 0
+                if retry_after:
+                    log.warning(f"Rate limit excedido: {identity} en {route}")
+                    await self._reject("Demasiadas solicitudes, intenta más tarde", retry_after)(scope, replay_receive, send)
+                    return
+
+            await self.app(scope, replay_receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+# Se registra antes que CORS para que las respuestas 429 también lleven cabeceras CORS
+app.add_middleware(
+    AdmissionControlMiddleware,
+    store=TokenBucketStore(LOCAL_STATE_DB_PATH),
+    concurrency_limit=DB_CONCURRENCY_LIMIT,
+)
+
 # --- CONFIGURACIÓN CORS ---
 app.add_middleware(
     CORSMiddleware,
@@ -104,56 +351,394 @@ class RegistroDescanso(BaseModel):
     duracion_seg: int
 
 # --- BASE DE DATOS Y DEPENDENCIAS ---
+# Réplica de lectura opcional: las consultas de solo lectura van a DATABASE_READ_URL
+# salvo que el usuario/sesión haya escrito hace poco (read-your-writes) o la
+# réplica esté caída o con demasiado retraso, en cuyo caso se usa el primario.
+READ_STICKY_SEC = float(os.getenv("READ_STICKY_SEC", "5"))
+REPLICA_MAX_LAG_SEC = float(os.getenv("REPLICA_MAX_LAG_SEC", "2"))
+REPLICA_CHECK_SEC = float(os.getenv("REPLICA_CHECK_SEC", "5"))
+REPLICA_RETRY_SEC = float(os.getenv("REPLICA_RETRY_SEC", "30"))
+# Un host de réplica inalcanzable no debe colgar la petición hasta el timeout TCP del SO
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "2"))
+
+
+def parse_database_url(database_url):
+    parsed_url = urllib.parse.urlparse(database_url)
+    return {
+        "host": parsed_url.hostname,
+        "port": parsed_url.port or 5432,
+        "database": parsed_url.path.strip("/"),
+        "user": parsed_url.username,
+        "password": parsed_url.password,
+    }
+
+
+class StickyWriteStore(LocalStateStore):
+    """Marca usuarios/sesiones con escrituras recientes, compartido entre workers."""
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS sticky_writes (key TEXT PRIMARY KEY, until REAL NOT NULL)"
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._calls = 0
+
+    def mark(self, keys):
+        if not keys:
+            return
+        now = time.time()
+        conn = self._conn()
+        conn.executemany(
+            "INSERT INTO sticky_writes (key, until) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET until = MAX(until, excluded.until)",
+            [(key, now + READ_STICKY_SEC) for key in keys],
+        )
+        self._calls += 1
+        if self._calls % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM sticky_writes WHERE until < ?", (now,))
+
+    def is_sticky(self, keys):
+        if not keys:
+            return False
+        conn = self._conn()
+        placeholders = ",".join("?" for _ in keys)
+        row = conn.execute(
+            f"SELECT 1 FROM sticky_writes WHERE key IN ({placeholders}) AND until > ? LIMIT 1",
+            (*keys, time.time()),
+        ).fetchone()
+        return row is not None
+
+
+sticky_writes = StickyWriteStore(LOCAL_STATE_DB_PATH)
+
+
+class ReplicaHealth:
+    """Estado de la réplica en este worker: retraso cacheado y pausa tras fallos."""
+
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Solo un hilo intenta crear el pool de la réplica; el resto va al primario
+        self.connect_lock = threading.Lock()
+        self.down_until = 0.0
+        self.checked_at = 0.0
+        self.lagging = False
+
+    def available(self):
+        # Con retraso se vuelve a probar la réplica cuando toca revisar el lag
+        if time.time() < self.down_until:
+            return False
+        return not self.lagging or self.needs_check()
+
+    def mark_down(self):
+        with self.lock:
+            self.down_until = time.time() + REPLICA_RETRY_SEC
+
+    def needs_check(self):
+        return time.time() - self.checked_at >= REPLICA_CHECK_SEC
+
+    def check_lag(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(self.LAG_QUERY)
+            lag = float(cur.fetchone()[0] or 0)
+        conn.rollback()
+        with self.lock:
+            self.checked_at = time.time()
+            was_lagging, self.lagging = self.lagging, lag > REPLICA_MAX_LAG_SEC
+        if self.lagging and not was_lagging:
+            log.warning(f"Réplica con retraso de {lag:.1f}s, lecturas al primario")
+        return not self.lagging
+
+
+replica_health = ReplicaHealth()
+
+
+# --- ARRANQUE Y CALENTAMIENTO ---
+# La app se puede construir con `gunicorn --preload`: a nivel de módulo no se abre
+# ninguna conexión (BD, SQLite, HTTP). Los pools y el cliente de N8N se crean en
+# `startup`, que corre en cada worker después del fork. Las importaciones pesadas
+# (fastapi, psycopg2, httpx) quedan en el módulo para que el master las comparta.
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", "2"))
+# El pool abre y conserva DB_POOL_WARM conexiones desde el arranque
+DB_POOL_MIN = min(max(1, DB_POOL_WARM), DB_POOL_MAX)
+N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL", "https://drteneguznay.app.n8n.cloud/webhook/visual-fatigue-diagnosis")
+N8N_WARMUP = os.getenv("N8N_WARMUP", "1") != "0"
+
+boot_stats = {
+    "pid": None,
+    "import_ms": None,
+    "startup_ms": None,
+    "warmup_ms": None,
+    "db_error": None,
+    "n8n_error": None,
+    "ready": False,
+}
+_n8n_client = None
+_n8n_client_lock = threading.Lock()
+
+
+def get_n8n_client():
+    """Cliente HTTP compartido para N8N, creado en el worker (nunca antes del fork)."""
+    global _n8n_client
+    if _n8n_client is None:
+        with _n8n_client_lock:
+            if _n8n_client is None:
+                _n8n_client = httpx.Client(timeout=60)
+    return _n8n_client
+
+
+def check_db_pool(db_pool):
+    """Comprueba que el pool responde (las conexiones ya las abre el pool con DB_POOL_MIN)."""
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+    finally:
+        db_pool.putconn(conn, close=bool(conn.closed))
+
+
+def warmup_n8n(started):
+    """Crea el cliente de N8N y abre la conexión TLS sin disparar el webhook."""
+    try:
+        if N8N_WARMUP and N8N_WEBHOOK_URL:
+            parsed_url = urllib.parse.urlparse(N8N_WEBHOOK_URL)
+            get_n8n_client().head(f"{parsed_url.scheme}://{parsed_url.netloc}/", timeout=5)
+    except Exception as e:
+        # N8N no es imprescindible (save-fatigue tolera sus fallos): se reporta pero no bloquea
+        log.warning(f"Calentamiento de N8N fallido (no bloqueante): {e}")
+        boot_stats["n8n_error"] = str(e)
+    finally:
+        boot_stats["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        boot_stats["ready"] = boot_stats["db_error"] is None
+        log.info(f"Calentamiento terminado: {boot_stats}")
+
+
 @app.on_event("startup")
 def startup():
+    started = time.perf_counter()
+    boot_stats["pid"] = os.getpid()
     try:
         # Priorizar DATABASE_URL si está presente (formato Render)
         database_url = os.getenv("DATABASE_URL")
         if database_url:
-            parsed_url = urllib.parse.urlparse(database_url)
-            db_config = {
-                "host": parsed_url.hostname,
-                "port": parsed_url.port or 5432,
-                "database": parsed_url.path.strip("/"),
-                "user": parsed_url.username,
-                "password": parsed_url.password,
-            }
+            db_config = parse_database_url(database_url)
         else:
             raise ValueError("DATABASE_URL environment variable is not set. Database connection cannot be established.")
         
         # SimpleConnectionPool es thread-safe
-        app.state.db_pool = pool.SimpleConnectionPool(1, 20, **db_config)
+        app.state.db_pool = pool.SimpleConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **db_config)
         log.info("Conexión a base de datos establecida.")
     except Exception as e:
         log.exception("Error conectando a PostgreSQL")
         raise e
 
+    # La réplica es opcional: si falla se sigue sirviendo todo desde el primario
+    database_read_url = os.getenv("DATABASE_READ_URL")
+    app.state.db_read_config = None
+    if database_read_url:
+        app.state.db_read_config = dict(parse_database_url(database_read_url), connect_timeout=REPLICA_CONNECT_TIMEOUT)
+    # El pool de la réplica se crea en la primera lectura, para que una réplica
+    # caída no retrase el arranque del worker
+    app.state.db_read_pool = None
+
+    # El pool se comprueba aquí (antes de aceptar tráfico); N8N en segundo plano
+    try:
+        check_db_pool(app.state.db_pool)
+    except psycopg2.Error as e:
+        log.exception("Error comprobando el pool de conexiones")
+        boot_stats["db_error"] = str(e)
+    boot_stats["startup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    threading.Thread(target=warmup_n8n, args=(started,), name="warmup-n8n", daemon=True).start()
+
 @app.on_event("shutdown")
 def shutdown():
-    db_pool = getattr(app.state, "db_pool", None)
-    if db_pool:
-        db_pool.closeall()
+    for name in ("db_pool", "db_read_pool"):
+        db_pool = getattr(app.state, name, None)
+        if db_pool:
+            db_pool.closeall()
+    if _n8n_client is not None:
+        _n8n_client.close()
+
+@app.get("/ready", include_in_schema=False)
+def readiness():
+    """Readiness: 200 cuando el worker terminó el calentamiento y la BD responde, 503 si no."""
+    # Si la BD falló al arrancar se reintenta aquí, para no quedar fuera de servicio para siempre
+    if boot_stats["warmup_ms"] is not None and boot_stats["db_error"] is not None:
+        try:
+            check_db_pool(app.state.db_pool)
+            boot_stats["db_error"] = None
+            boot_stats["ready"] = True
+        except psycopg2.Error as e:
+            boot_stats["db_error"] = str(e)
+    return JSONResponse(boot_stats, status_code=200 if boot_stats["ready"] else 503)
+
+async def get_routing_keys(request: Request):
+    """Claves de read-your-writes (usuario y sesión) tomadas de la ruta o del cuerpo JSON."""
+    values = dict(request.path_params)
+    try:
+        body = await request.json() if await request.body() else None
+    except ValueError:
+        body = None
+    if isinstance(body, dict):
+        values.update(body)
+    keys = []
+    if values.get("usuario_id") is not None:
+        keys.append(f"u:{values['usuario_id']}")
+    if values.get("sesion_id") is not None:
+        keys.append(f"s:{values['sesion_id']}")
+    return keys
+
+def _add_session_owner(conn, keys):
+    """
+    Escrituras que solo traen sesion_id (end-session, registrar-descanso, diagnóstico)
+    también cambian el historial del dueño: se añade su clave u: para read-your-writes.
+    """
+    sesion_keys = [key for key in keys if key.startswith("s:")]
+    if not sesion_keys or any(key.startswith("u:") for key in keys):
+        return keys
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT usuario_id FROM sesiones WHERE id = %s", (sesion_keys[0][2:],))
+            row = cur.fetchone()
+    except psycopg2.Error:
+        conn.rollback()
+        return keys
+    return keys + [f"u:{row[0]}"] if row else keys
+
+def _mark_writes(keys):
+    try:
+        sticky_writes.mark(keys)
+    except sqlite3.Error:
+        log.exception("Error registrando escritura reciente")
+
+def _get_read_pool():
+    """Pool de la réplica, creándolo si aún no existe (None mientras no esté disponible)."""
+    read_pool = getattr(app.state, "db_read_pool", None)
+    db_read_config = getattr(app.state, "db_read_config", None)
+    if read_pool or not db_read_config:
+        return read_pool
+    # Si otro hilo ya está conectando no se espera: esta lectura va al primario
+    if not replica_health.connect_lock.acquire(blocking=False):
+        return None
+    try:
+        if app.state.db_read_pool is None and time.time() >= replica_health.down_until:
+            try:
+                # minconn=1: un solo intento de conexión, acotado por connect_timeout
+                app.state.db_read_pool = pool.SimpleConnectionPool(1, DB_POOL_MAX, **db_read_config)
+                log.info("Conexión a réplica de lectura establecida.")
+            except psycopg2.Error:
+                log.exception("Error conectando a la réplica de lectura, se usará el primario")
+                replica_health.mark_down()
+        return app.state.db_read_pool
+    finally:
+        replica_health.connect_lock.release()
+
+def _set_timezone(conn):
+    # Configurar zona horaria por conexión
+    with conn.cursor() as cur:
+        cur.execute("SET TIME ZONE 'America/Guayaquil'")
+
+def _discard_read_pool(read_pool):
+    """
+    Marca la réplica como caída y suelta su pool: las conexiones ociosas están rotas y
+    se recrea uno nuevo pasado REPLICA_RETRY_SEC. Las peticiones en curso devuelven sus
+    conexiones al pool viejo, que se libera cuando ya nadie lo usa.
+    """
+    replica_health.mark_down()
+    with replica_health.lock:
+        if getattr(app.state, "db_read_pool", None) is read_pool:
+            app.state.db_read_pool = None
+
+def _get_replica_conn(keys):
+    """(pool, conexión) de la réplica, o (None, None) si la lectura debe ir al primario."""
+    if not replica_health.available():
+        return None, None
+    try:
+        if sticky_writes.is_sticky(keys):
+            return None, None
+    except sqlite3.Error:
+        log.exception("Error consultando escrituras recientes")
+        return None, None
+    read_pool = _get_read_pool()
+    if not read_pool:
+        return None, None
+
+    try:
+        conn = read_pool.getconn()
+    except psycopg2.Error:
+        log.exception("Réplica no disponible, lectura al primario")
+        _discard_read_pool(read_pool)
+        return None, None
+    try:
+        if replica_health.needs_check() and not replica_health.check_lag(conn):
+            read_pool.putconn(conn)
+            return None, None
+        # También valida la conexión del pool: si la réplica cayó, falla aquí y no en el endpoint
+        _set_timezone(conn)
+    except psycopg2.Error:
+        log.exception("Réplica no disponible, lectura al primario")
+        read_pool.putconn(conn, close=True)
+        _discard_read_pool(read_pool)
+        return None, None
+    return read_pool, conn
+
+def _db_session(db_pool, conn, set_timezone=True):
+    try:
+        if set_timezone:
+            _set_timezone(conn)
+        yield conn
+    except Exception:
+        # Si ocurre un error no manejado, hacemos rollback por seguridad
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Devolver conexión al pool siempre (descartándola si quedó cerrada)
+        db_pool.putconn(conn, close=bool(conn.closed))
 
 # INYECCIÓN DE DEPENDENCIA (NUEVO)
 # Maneja automáticamente el ciclo de vida de la conexión para cada request
-def get_db():
+def get_db(keys: list = Depends(get_routing_keys)):
+    """Conexión al primario. Marca usuario/sesión para leer del primario durante READ_STICKY_SEC."""
     db_pool = getattr(app.state, "db_pool", None)
     if not db_pool:
         raise HTTPException(status_code=500, detail="Conexión BD no disponible")
-    
+
+    # Se marca antes (cubre lecturas concurrentes) y después (la escritura pudo tardar)
     conn = db_pool.getconn()
+    keys = _add_session_owner(conn, keys)
+    _mark_writes(keys)
     try:
-        # Configurar zona horaria por conexión
-        with conn.cursor() as cur:
-            cur.execute("SET TIME ZONE 'America/Guayaquil'")
-        yield conn
-    except Exception:
-        # Si ocurre un error no manejado, hacemos rollback por seguridad
-        conn.rollback()
-        raise
+        yield from _db_session(db_pool, conn)
     finally:
-        # Devolver conexión al pool siempre
-        db_pool.putconn(conn)
+        _mark_writes(keys)
+
+def get_read_db(keys: list = Depends(get_routing_keys)):
+    """Conexión para endpoints de solo lectura: réplica si está sana, si no el primario."""
+    read_pool, conn = _get_replica_conn(keys)
+    if conn is None:
+        db_pool = getattr(app.state, "db_pool", None)
+        if not db_pool:
+            raise HTTPException(status_code=500, detail="Conexión BD no disponible")
+        yield from _db_session(db_pool, db_pool.getconn())
+        return
+
+    try:
+        # La zona horaria ya se configuró al validar la conexión en _get_replica_conn
+        yield from _db_session(read_pool, conn, set_timezone=False)
+    finally:
+        # Una conexión de réplica que vuelve cerrada indica que la réplica cayó
+        if conn.closed:
+            log.warning("Conexión de réplica perdida, lecturas al primario")
+            _discard_read_pool(read_pool)
 
 
 # --- ENDPOINTS AUTH ---
@@ -276,7 +861,7 @@ def save_fatigue(data: FatigueResult, db = Depends(get_db)):
     """
     Guarda el resultado final y consulta N8N.
     Se ha cambiado a 'def' (síncrono) para evitar bloqueos del event loop por psycopg2.
-    La llamada a N8N se hace con httpx.Client (síncrono) dentro de este hilo.
+    La llamada a N8N se hace con el httpx.Client compartido (síncrono) dentro de este hilo.
     """
     diagnostico_ia = None
     payload_to_n8n = {}
@@ -316,7 +901,7 @@ def save_fatigue(data: FatigueResult, db = Depends(get_db)):
         # 2. Llamada a N8N (Síncrona ahora, para correr en el ThreadPool)
         payload_to_n8n = {}
         try:
-            n8n_webhook_url = os.getenv("N8N_WEBHOOK_URL", "https://drteneguznay.app.n8n.cloud/webhook/visual-fatigue-diagnosis")
+            n8n_webhook_url = N8N_WEBHOOK_URL
             log.info("--- INICIO LLAMADA A N8N (SYNC) ---")
 
             if n8n_webhook_url:
@@ -338,24 +923,24 @@ def save_fatigue(data: FatigueResult, db = Depends(get_db)):
                 payload_to_n8n = {"resumen_sesion": resumen_sesion_payload}
                 log.info(f"Payload enviado a N8N: {json.dumps(payload_to_n8n)}")
 
-                # Usamos Client síncrono
-                with httpx.Client() as client:
-                    response = client.post(n8n_webhook_url, json=payload_to_n8n, timeout=60)
-                    log.info(f"N8N Status Code: {response.status_code}")
-                    log.info(f"N8N Response Content: {response.text}")
-                    response.raise_for_status()
-                    responseData = response.json()
-                    log.info(f"N8N Parsed JSON: {responseData}")
-
-                    diagnostico_ia = None
-                    if isinstance(responseData, list) and responseData:
-                        if isinstance(responseData[0], dict) and 'json' in responseData[0]:
-                            diagnostico_ia = responseData[0]['json']
-                        elif isinstance(responseData[0], dict):
-                            diagnostico_ia = responseData[0]
-
-                    if diagnostico_ia is None:
-                        diagnostico_ia = responseData
+                # Usamos el Client síncrono compartido (conexión ya calentada)
+                client = get_n8n_client()
+                response = client.post(n8n_webhook_url, json=payload_to_n8n, timeout=60)
+                log.info(f"N8N Status Code: {response.status_code}")
+                log.info(f"N8N Response Content: {response.text}")
+                response.raise_for_status()
+                responseData = response.json()
+                log.info(f"N8N Parsed JSON: {responseData}")
+
+                diagnostico_ia = None
+                if isinstance(responseData, list) and responseData:
+                    if isinstance(responseData[0], dict) and 'json' in responseData[0]:
+                        diagnostico_ia = responseData[0]['json']
+                    elif isinstance(responseData[0], dict):
+                        diagnostico_ia = responseData[0]
+
+                if diagnostico_ia is None:
+                    diagnostico_ia = responseData
 
                 if diagnostico_ia and sesion_id:
                     try:
@@ -406,7 +991,7 @@ def save_fatigue(data: FatigueResult, db = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/get-user-history")
-def get_user_history(data: DashboardRequest, db = Depends(get_db)):
+def get_user_history(data: DashboardRequest, db = Depends(get_read_db)):
     try:
         cur = db.cursor(cursor_factory=extras.RealDictCursor)
 
@@ -516,7 +1101,7 @@ def end_session(sesion_id: int, db = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/sesiones/{sesion_id}")
-def get_sesion_details(sesion_id: int, db = Depends(get_db)):
+def get_sesion_details(sesion_id: int, db = Depends(get_read_db)):
     try:
         cur = db.cursor(cursor_factory=extras.RealDictCursor)
         cur.execute(
@@ -627,7 +1212,7 @@ def get_or_create_diagnosis(data: DetailRequest, db = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/get-session-details")
-def get_session_details(data: DetailRequest, db = Depends(get_db)):
+def get_session_details(data: DetailRequest, db = Depends(get_read_db)):
     try:
         cur = db.cursor(cursor_factory=extras.RealDictCursor)
         cur.execute("SELECT etapa, perclos, parpadeos, velocidad_ocular, num_bostezos, nivel_subjetivo, estado_fatiga FROM mediciones WHERE sesion_id = %s", (data.sesion_id,))
@@ -635,4 +1220,7 @@ def get_session_details(data: DetailRequest, db = Depends(get_db)):
         datos = {fila["etapa"]: fila for fila in filas} # Nota: 'etapa' no existe en lógica continua, pero se mantiene por compatibilidad
         return datos
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+# Fin de la importación del módulo (con --preload ocurre una sola vez, en el master)
+boot_stats["import_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
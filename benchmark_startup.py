@@ -0,0 +1,156 @@
+import argparse
+import os
+import re
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+# Benchmark de arranque en frío del backend:
+# 1. Tiempo de importación de backend.backend en intérpretes nuevos. Con
+#    `gunicorn --preload` este coste se paga una vez en el master y los workers
+#    lo heredan con el fork, por eso las dependencias se importan en el módulo.
+# 2. Tiempo hasta /ready y hasta la primera respuesta de /login, con uvicorn
+#    (un proceso) o con el comando de gunicorn del Procfile (--preload y fork de
+#    workers, esperando el /ready de cada worker). Requiere DATABASE_URL
+#    apuntando a una BD PostgreSQL de pruebas.
+# Con --max-import-ms / --max-ready-ms el script termina con código 1 si se
+# superan los límites, para que las regresiones sean visibles.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+N_IMPORTS = 5
+N_ARRANQUES = 3
+TIMEOUT_SECONDS = 60.0
+
+IMPORT_SNIPPET = """
+import time
+t = time.perf_counter()
+import backend.backend
+print((time.perf_counter() - t) * 1000)
+"""
+
+
+def medir_importacion():
+    tiempos = []
+    for _ in range(N_IMPORTS):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout
+        tiempos.append(float(out))
+    return tiempos
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def comando_procfile(port):
+    """Comando `web:` del Procfile con $PORT sustituido, y su número de workers."""
+    with open(os.path.join(ROOT, "Procfile")) as f:
+        linea = next(l for l in f if l.startswith("web:"))
+    cmd = shlex.split(linea[len("web:"):].replace("$PORT", str(port)))
+    workers = re.search(r"(?:-w|--workers)[ =](\d+)", linea)
+    return [sys.executable, "-m"] + cmd, int(workers.group(1)) if workers else 1
+
+
+def medir_arranque(modo):
+    """
+    Lanza el servidor y mide el tiempo hasta que todos los workers responden /ready (200)
+    y hasta la primera respuesta de /login.
+    """
+    port = puerto_libre()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, N8N_WARMUP=os.getenv("N8N_WARMUP", "0"))
+    if modo == "gunicorn":
+        cmd, n_workers = comando_procfile(port)
+    else:
+        cmd, n_workers = [sys.executable, "-m", "uvicorn", "backend.backend:app", "--port", str(port)], 1
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        listos = {}
+        # Sin keep-alive cada petición puede caer en un worker distinto
+        with httpx.Client(timeout=2, headers={"Connection": "close"}) as client:
+            while len(listos) < n_workers and time.perf_counter() - start < TIMEOUT_SECONDS:
+                if proc.poll() is not None:
+                    raise RuntimeError("El servidor terminó durante el arranque")
+                try:
+                    r = client.get(f"{base_url}/ready")
+                except httpx.TransportError:
+                    time.sleep(0.02)
+                    continue
+                if r.status_code == 200:
+                    boot = r.json()
+                    listos.setdefault(boot["pid"], boot)
+                else:
+                    time.sleep(0.02)
+            if len(listos) < n_workers:
+                raise RuntimeError(f"Timeout esperando /ready ({len(listos)}/{n_workers} workers listos)")
+            t_ready = time.perf_counter() - start
+
+            client.post(f"{base_url}/login", json={"correo": "benchmark@test.com", "contrasena": "x"})
+            t_login = time.perf_counter() - start
+        return t_ready * 1000, t_login * 1000, list(listos.values())
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío")
+    parser.add_argument("--max-import-ms", type=float, help="Límite para la mediana de importación")
+    parser.add_argument("--max-ready-ms", type=float, help="Límite para la mediana hasta /ready")
+    parser.add_argument(
+        "--modo", choices=["gunicorn", "uvicorn"], default="gunicorn",
+        help="gunicorn: comando del Procfile (--preload + workers); uvicorn: un solo proceso",
+    )
+    args = parser.parse_args()
+    fallos = []
+
+    print(f"--- BENCHMARK DE ARRANQUE EN FRÍO ---")
+    tiempos = medir_importacion()
+    mediana_import = statistics.median(tiempos)
+    print("\n" + "="*40)
+    print(f"IMPORTACIÓN (N={N_IMPORTS})")
+    print("-" * 40)
+    print(f"Mediana:                {mediana_import:.1f} ms")
+    print(f"Mín / Máx:              {min(tiempos):.1f} / {max(tiempos):.1f} ms")
+    if args.max_import_ms and mediana_import > args.max_import_ms:
+        fallos.append(f"importación {mediana_import:.1f} ms > {args.max_import_ms} ms")
+
+    if os.getenv("DATABASE_URL"):
+        ready, login = [], []
+        for _ in range(N_ARRANQUES):
+            t_ready, t_login, workers = medir_arranque(args.modo)
+            ready.append(t_ready)
+            login.append(t_login)
+        mediana_ready = statistics.median(ready)
+        print("\n" + "="*40)
+        print(f"ARRANQUE {args.modo.upper()} (N={N_ARRANQUES})")
+        print("-" * 40)
+        print(f"Hasta /ready (todos):   {mediana_ready:.1f} ms")
+        print(f"Hasta primer /login:    {statistics.median(login):.1f} ms")
+        for boot in workers:
+            print(f"Worker {boot['pid']}:  import {boot['import_ms']} ms, "
+                  f"startup {boot['startup_ms']} ms, warm-up {boot['warmup_ms']} ms")
+        if args.max_ready_ms and mediana_ready > args.max_ready_ms:
+            fallos.append(f"arranque {mediana_ready:.1f} ms > {args.max_ready_ms} ms")
+    else:
+        print("\nDATABASE_URL no definida: se omite el benchmark de arranque.")
+    print("="*40)
+
+    for fallo in fallos:
+        print(f"REGRESIÓN: {fallo}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()